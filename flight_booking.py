@@ -1,28 +1,131 @@
-import requests # used for handling http requests
 import argparse # used for handling user inputs to the script
-from sys import exit # used to terminate script on connection exception
-from functools import wraps # used to create decorator for handling exceptions on request functions
-
-# decorator that is used on FlightBooker class functions that handle http requests
-# cathing connection and http exceptions
-def handling_request(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        try:
-            f_outcome = f(*args, **kwargs)
-        except requests.exceptions.HTTPError as e:
-            print(e)
-            exit(1)
-        except requests.exceptions.ConnectionError:
-            print("Failed to establish connection, check your internet settings and try again")
-            exit(1)
-        except requests.exceptions.Timeout:
-            print("Connection timed out")
-            exit(1)
-
-        return f_outcome
-
-    return decorated_function
+import dbm # used to handle errors of cache file
+import hashlib # used to create cache keys from search filter
+import json # used to serialize search filter for cache key
+import operator # used to select flight attributes when searching for min
+import os # used to locate cache file in user home directory
+import pickle # used to handle errors of damaged cache entries
+import shelve # used as on-disk cache of search responses
+import threading # used to check flight in background while user decides on booking
+import types # used to make search filter read-only
+import time # used to check age of cached search responses
+from contextlib import contextmanager # used to create context manager for handling exceptions on requests
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError # used to collect result of flight check done in background
+from dataclasses import dataclass, field # used to hold parsed input arguments
+from datetime import datetime, date # used to derive cache ttl from departure date
+
+# orjson is used as faster json parser and serializer if installed,
+# falling back to standard library json otherwise
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+# ijson is used to parse search response incrementally while it is downloaded
+# if installed, otherwise whole response is parsed at once
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# shared session reusing pooled keep-alive connections to kiwi endpoints, so
+# consecutive requests don't pay for new tcp and tls handshake every time,
+# it is created on first use together with importing requests, so the script
+# starts faster when only printing help or failing on invalid arguments
+_SESSION = None
+
+def get_session():
+    global _SESSION
+    if _SESSION is None:
+        import requests # used for handling http requests
+        from requests.adapters import HTTPAdapter # used to configure connection pooling and retries on the session
+        from urllib3.util.retry import Retry # used to retry transient server errors
+
+        _SESSION = requests.Session()
+        _SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=10,
+                                               max_retries=Retry(total=3, backoff_factor=0.3,
+                                                                 status_forcelist=[502, 503, 504],
+                                                                 raise_on_status=False)))
+        _SESSION.headers.update({
+                'User-Agent': 'kiwi_flight_search',
+                'Accept-Encoding': 'gzip, deflate',
+            })
+
+    return _SESSION
+
+def close_session():
+    # closes shared session if it was created
+    if _SESSION is not None:
+        _SESSION.close()
+
+# context manager that is used around http requests in FlightBooker class
+# catching connection and http exceptions and terminating script
+# including urllib3 exceptions raised when streamed response is read directly
+@contextmanager
+def http_errors():
+    import requests
+    import urllib3
+    try:
+        yield
+    except requests.exceptions.HTTPError as e:
+        raise SystemExit(str(e))
+    except requests.exceptions.ConnectionError:
+        raise SystemExit("Failed to establish connection, check your internet settings and try again")
+    except (requests.exceptions.Timeout, urllib3.exceptions.ReadTimeoutError):
+        raise SystemExit("Connection timed out")
+    except (requests.exceptions.ChunkedEncodingError, urllib3.exceptions.HTTPError):
+        raise SystemExit("Connection was interrupted while receiving response, try again")
+
+# on-disk cache of flight search responses, prices change on the order of minutes
+# so cached responses are valid only for short time
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.kiwi_flight_search_cache')
+CACHE_TTL = 10 * 60 # seconds, for searches departing in future
+CACHE_TTL_TODAY = 60 # seconds, for searches departing today
+
+CHECK_TIMEOUT = 10 # seconds, for flight check done in background
+CHECK_WAIT = 10 # seconds, waiting for unfinished flight check after booking is confirmed
+CHECK_ATTEMPTS = 5 # check flights is repeated until kiwi reports the flight as checked
+CHECK_INTERVAL = 1 # seconds, between repeated flight checks
+
+# flight details used for search and booking, all other fields of search
+# response are dropped right after parsing
+FLIGHT_FIELDS = ('price', 'duration', 'flyFrom', 'flyTo', 'fly_duration',
+                 'return_duration', 'booking_token')
+
+# constant part of booking data structure, completed with passengers details,
+# number of bags and booking token for each booking
+BOOKING_TEMPLATE = types.MappingProxyType({
+        "lang":"en",
+        "locale":"en",
+        "currency":"gbp",
+        "customerLoginID":"unknown",
+        "customerLoginName":"unknown",
+        "affily":"affil_id",
+        "booked_at":"affil_id",
+    })
+
+@dataclass(frozen=True, slots=True)
+class Config():
+    # read-only input configuration of the script created by InputHandler
+    # from parsed input arguments, priority is derived from cheapest
+    date: str
+    flight_from: str
+    to: str
+    one_way: bool
+    returning: int | None
+    cheapest: bool
+    fastest: bool
+    direct: bool
+    bags: int
+    no_cache: bool
+    priority: str = field(init=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'priority', 'cheapest' if self.cheapest else 'fastest')
 
 class InputHandler(argparse.ArgumentParser):
     # wrapper class around argparse.ArgumentParser handling all input parameters
@@ -30,7 +133,7 @@ class InputHandler(argparse.ArgumentParser):
     def __init__(self):
         super().__init__()
 
-        self.add_argument('--date', help='Specify departure date in "dd/mm/YYYY" format',
+        self.add_argument('--date', help='Specify departure date in "dd/mm/YYYY" format, or range of dates in "dd/mm/YYYY-dd/mm/YYYY" format',
                             type=str, required=True)
         self.add_argument('--flight_from', help='Specify departure airport IATA code',
                             type=str, required=True)
@@ -55,6 +158,9 @@ class InputHandler(argparse.ArgumentParser):
         self.add_argument('--bags', help='Specify how many big luggage you will carry, default is 0',
                             type=int, default=0)
 
+        self.add_argument('--no-cache', help='Always search for flights online, ignoring cached results',
+                            action='store_true', default=False)
+
         self.args = self.parse_args()
 
         # setting cheapest to true if fastest wasn't selected - making cheapest as a default
@@ -65,31 +171,54 @@ class InputHandler(argparse.ArgumentParser):
         if not self.args.returning:
             self.args.one_way = True
 
+        self.config = Config(
+                date=self.args.date,
+                flight_from=self.args.flight_from,
+                to=self.args.to,
+                one_way=self.args.one_way,
+                returning=self.args.returning,
+                cheapest=self.args.cheapest,
+                fastest=self.args.fastest,
+                direct=self.args.direct,
+                bags=self.args.bags,
+                no_cache=self.args.no_cache,
+            )
+
 class FlightBooker():
     # class handling request and performing all search and booking functions
-    # is initialized with parsed input arguments handled by InputHandler class,
-    # user details, search and booking uri
-    def __init__(self, input_config, search_uri, booking_uri, user_details):
+    # is initialized with input configuration created by InputHandler class,
+    # user details, search and booking uri, optionally with check flights uri
+    # verifying flight before booking and session used for http requests,
+    # module shared session is used by default
+    __slots__ = ('search_uri', 'booking_uri', 'check_uri', 'user_details', 'input_config',
+                 'flight_filter', 'flight_to_book', '_session')
+
+    def __init__(self, input_config, search_uri, booking_uri, user_details, check_uri=None, session=None):
+        self._session = session if session is not None else get_session()
         self.search_uri = search_uri
         self.booking_uri = booking_uri
+        self.check_uri = check_uri
         self.user_details = user_details
         self.input_config = input_config
         self.flight_filter = self.set_filter()
         self.flight_to_book = None
 
     def set_filter(self):
-        # Configures search query filter based on input arguments
+        # Configures search query filter based on input arguments, filter is
+        # read-only as it is also used as a cache key of the search
         fly_from = self.input_config.flight_from
         fly_to = self.input_config.to
-        date_from = self.input_config.date
-        date_to = self.input_config.date
+        date_from, _, date_to = self.input_config.date.partition('-') # searching in range of dates if specified
+        date_to = date_to or date_from
         partner = 'picky'
         direct_flights = 1 if self.input_config.direct else 0
         one_for_city = 1 if self.input_config.cheapest else 0 # this parameter is narrowing down the returend flight to one cheapest per city
         flight_type = 'round' if self.input_config.returning else 'oneway'
         days_in_destination = self.input_config.returning
+        sort = 'price' if self.input_config.cheapest else 'duration' # selecting most suitable flight on server side
+        limit = 1 # only the best flight by sort criteria is needed
 
-        return {
+        return types.MappingProxyType({
                 'flyFrom': fly_from,
                 'to': fly_to,
                 'dateFrom': date_from,
@@ -99,8 +228,10 @@ class FlightBooker():
                 'oneforcity': one_for_city,
                 'typeFlight': flight_type,
                 'daysInDestinationFrom': days_in_destination,
-                'daysInDestinationTo': days_in_destination
-            }
+                'daysInDestinationTo': days_in_destination,
+                'sort': sort,
+                'limit': limit
+            })
 
     def handle_booking(self):
         # main fucntion that handles the flight search and booking
@@ -109,30 +240,135 @@ class FlightBooker():
 
         if flights_data:
             self.flight_to_book = self.search_flight(flights_data)
+            # flight is checked in background as soon as it is chosen, so the
+            # check is done while details are shown and user decides on booking
+            precheck = self.start_precheck() if self.check_uri else None
             self.show_flight_details()
-            self.proceed_with_booking()
+            self.proceed_with_booking(precheck)
 
         else:
             print("No suitable flights were found based on your criteria")
 
     def search_message(self):
-        flight_priority = 'cheapest' if self.input_config.cheapest else 'fastest'
-        message = f"Searching for {flight_priority}, {self.flight_filter['typeFlight']} flight, from {self.flight_filter['flyFrom']} to {self.flight_filter['to']}"
+        message = f"Searching for {self.input_config.priority}, {self.flight_filter['typeFlight']} flight, from {self.flight_filter['flyFrom']} to {self.flight_filter['to']}"
         print(message)
 
-    @handling_request
     def get_flights(self):
+        # returns found flights data, using cached search response if there is
+        # fresh one for the same filter, otherwise performs search request
+        # and caches successful non-empty response, search is done without
+        # cache if cache file can't be used or the search can't be cached
+        if self.input_config.no_cache:
+            return self.request_flights()
+
+        cache_key = self.cache_key()
+        ttl = self.cache_ttl()
+        if not ttl:
+            return self.request_flights()
+
+        try:
+            with shelve.open(CACHE_PATH) as cache:
+                cached = cache.get(cache_key)
+        except (OSError, *dbm.error):
+            return self.request_flights()
+        except (pickle.UnpicklingError, EOFError, ValueError):
+            cached = None # damaged cache entry is treated as missing
+        if cached:
+            timestamp, flights_data = cached
+            if time.time() - timestamp < ttl:
+                return flights_data
+
+        flights_data = self.request_flights()
+        if flights_data:
+            self.cache_flights(cache_key, flights_data)
+
+        return flights_data
+
+    @staticmethod
+    def cache_flights(cache_key, flights_data):
+        # stores search response in cache, removing expired and damaged
+        # entries so the cache file doesn't grow with every distinct search
+        now = time.time()
+        try:
+            with shelve.open(CACHE_PATH) as cache:
+                for key in list(cache.keys()):
+                    try:
+                        timestamp, _ = cache[key]
+                    except (pickle.UnpicklingError, EOFError, ValueError, TypeError):
+                        timestamp = 0
+                    if now - timestamp >= CACHE_TTL:
+                        del cache[key]
+
+                cache[cache_key] = (now, flights_data)
+        except (OSError, *dbm.error):
+            pass
+
+    def cache_key(self):
+        # creates cache key as a hash of the search filter
+        serialized_filter = json.dumps(dict(self.flight_filter), sort_keys=True).encode()
+        return hashlib.blake2b(serialized_filter).hexdigest()
+
+    def cache_ttl(self):
+        # flights departing today are changing quickly so they are cached
+        # only for short time
+        try:
+            departure = datetime.strptime(self.flight_filter['dateFrom'], '%d/%m/%Y').date()
+        except ValueError:
+            return 0
+        return CACHE_TTL_TODAY if departure <= date.today() else CACHE_TTL
+
+    def request_flights(self):
         # performs get request on flight search endpoint returning found flights data
-        r = requests.get(self.search_uri, params=self.flight_filter)
-        r.raise_for_status()
+        if ijson is not None:
+            return self.stream_flights()
+
+        with http_errors():
+            r = self._session.get(self.search_uri, params=self.flight_filter)
+            r.raise_for_status()
 
         if r.status_code == 200:
-            return r.json()['data']
+            try:
+                response_data = json_loads(r.content)
+            except ValueError:
+                raise SystemExit("Invalid response received from flight search")
+            # response without flights data is handled as no flights found,
+            # same as when the response is streamed
+            flights_data = response_data.get('data', []) if isinstance(response_data, dict) else []
+            return [self.project_flight(flight) for flight in flights_data]
+
+    def stream_flights(self):
+        # performs streamed get request on flight search endpoint, flights are
+        # parsed one by one while downloading and only the most suitable one
+        # is kept, so the whole response is never held in memory
+        # exceptions are handled for the whole parsing as response is still downloaded
+        with http_errors():
+            with self._session.get(self.search_uri, params=self.flight_filter, stream=True) as r:
+                r.raise_for_status()
+
+                if r.status_code == 200:
+                    r.raw.decode_content = True
+                    flights = (self.project_flight(flight)
+                               for flight in ijson.items(r.raw, 'data.item', use_float=True))
+                    try:
+                        if self.input_config.cheapest:
+                            flight = self.find_cheapest_flight(flights)
+                        else:
+                            flight = self.find_fastest_flight(flights)
+                    except ijson.JSONError:
+                        raise SystemExit("Invalid response received from flight search")
+
+                    return [flight] if flight else []
+
+    @staticmethod
+    def project_flight(flight):
+        # keeps only flight details used for search and booking
+        return {name: flight[name] for name in FLIGHT_FIELDS if name in flight}
 
     def search_flight(self, flights_data):
         # function that search for most suitable flight based on input criteria
-        # if there is only one flight returned it means it is also the cheapest
-        # and fastest
+        # flights are sorted and limited by search endpoint, so if there is only
+        # one flight returned it is the most suitable one, searching locally
+        # is kept as fallback in case endpoint ignored sort and limit
         if len(flights_data) == 1:
             return flights_data[0]
         # else search for cheapest flight if cheapest criteria was selected
@@ -144,29 +380,13 @@ class FlightBooker():
 
     @staticmethod
     def find_fastest_flight(flights_data):
-        # iterates over all fligts comparing flight duration and returns shortest flight
-        fastest_flight = flights_data[0]
-        min_duration = fastest_flight['duration']['total']
-        for flight in flights_data[1:]:
-            flight_duration = flight['duration']['total']
-            if flight_duration < min_duration:
-                min_duration = flight_duration
-                fastest_flight = flight
-
-        return fastest_flight
+        # returns flight with shortest total duration, None if there are no flights
+        return min(flights_data, key=lambda flight: flight['duration']['total'], default=None)
 
     @staticmethod
     def find_cheapest_flight(flights_data):
-        # iterates over all fligts comparing price and returns cheapest flight
-        cheapest_flight = flights_data[0]
-        min_price = cheapest_flight['price']
-        for flight in flights_data[1:]:
-            flight_price = flight['price']
-            if flight_price < min_price:
-                min_price = flight_price
-                cheapest_flight = flight
-
-        return cheapest_flight
+        # returns flight with lowest price, None if there are no flights
+        return min(flights_data, key=operator.itemgetter('price'), default=None)
 
     def show_flight_details(self):
         # prints details of the flight to be booked
@@ -181,46 +401,121 @@ class FlightBooker():
             if self.input_config.returning:
                 print(f"Return duration: {self.flight_to_book['return_duration']}")
 
-    def proceed_with_booking(self):
-        # asks user to confirm booking and completes it
+    def proceed_with_booking(self, precheck=None):
+        # asks user to confirm booking and completes it, using result of
+        # flight check running in background if there is one
         print("")
+        if self.confirm("Do you wish to book the flight?"):
+            self.book_flight(self.checked_flight(precheck))
+        else:
+            print("Flight wasn't booked")
+
+    @staticmethod
+    def confirm(question):
+        # asks user yes/no question until valid answer is given
         choice = ''
-        while choice.lower() not in ('y', 'n'):
-            choice = input("Do you wish to book the flight? y/n: ")
-            if choice.lower() == 'y':
-                self.book_flight()
-            elif choice.lower() == 'n':
-                print("Flight wasn't booked")
-
-    @handling_request
-    def book_flight(self):
+        while choice not in ('y', 'n'):
+            choice = input(f"{question} y/n: ").strip().lower()[:1]
+
+        return choice == 'y'
+
+    def start_precheck(self):
+        # runs flight check on daemon thread returning future with its result,
+        # the thread isn't waited for, so the script doesn't block on unfinished
+        # check when user declines booking or interrupts the script
+        precheck = Future()
+
+        def run_precheck():
+            precheck.set_running_or_notify_cancel()
+            try:
+                precheck.set_result(self.precheck_flight())
+            except Exception as e:
+                precheck.set_exception(e)
+
+        threading.Thread(target=run_precheck, daemon=True).start()
+        return precheck
+
+    def precheck_flight(self):
+        # performs get requests on check flights endpoint verifying actual
+        # flight price and availability, kiwi needs the check to be repeated
+        # until flights_checked is reported, exceptions are handled when result
+        # is collected in checked_flight
+        params = {
+                'v': 2,
+                'booking_token': self.flight_to_book['booking_token'],
+                'bnum': self.input_config.bags,
+                'pnum': 1,
+            }
+        for attempt in range(CHECK_ATTEMPTS):
+            if attempt:
+                time.sleep(CHECK_INTERVAL)
+            r = self._session.get(self.check_uri, params=params, timeout=CHECK_TIMEOUT)
+            r.raise_for_status()
+
+            checked_flight = json_loads(r.content)
+            if isinstance(checked_flight, dict) and checked_flight.get('flights_checked'):
+                break
+
+        return checked_flight
+
+    @staticmethod
+    def checked_flight(precheck):
+        # returns result of the flight check, booking proceeds without it
+        # if check wasn't done, failed, didn't finish in time or wasn't
+        # finished by kiwi yet
+        if precheck is None:
+            return None
+
+        import requests
+        try:
+            checked_flight = precheck.result(timeout=CHECK_WAIT)
+        except (requests.exceptions.RequestException, ValueError, FutureTimeoutError):
+            checked_flight = None
+
+        if not isinstance(checked_flight, dict) or not checked_flight.get('flights_checked'):
+            print("Flight couldn't be checked before booking")
+            return None
+
+        return checked_flight
+
+    def book_flight(self, checked_flight=None):
         # sends post request to booking endpoint and confirms user with booking
-        # id of the flight
+        # id of the flight, if the flight was checked before booking, unavailable
+        # flights aren't booked and user has to confirm changed price
+        if checked_flight:
+            if checked_flight.get('flights_invalid'):
+                print("")
+                print("Flight is no longer available, it wasn't booked")
+                return
+            if checked_flight.get('price_change'):
+                print("")
+                print(f"Flight price has changed, new price: {checked_flight.get('total', 'unknown')}")
+                if not self.confirm("Do you wish to book the flight for the new price?"):
+                    print("Flight wasn't booked")
+                    return
+
         headers = {'Content-Type': 'application/json'}
 
         # booking data structure with prefilled info, completing passengers details
         # number of bags and booking token from the class parameters
         booking_data = {
-                "lang":"en",
+                **BOOKING_TEMPLATE,
                 "bags": self.input_config.bags,
                 "passengers":[ self.user_details ],
-                "locale":"en",
-                "currency":"gbp",
-                "customerLoginID":"unknown",
-                "customerLoginName":"unknown",
                 "booking_token": self.flight_to_book['booking_token'],
-                "affily":"affil_id",
-                "booked_at":"affil_id",
                 }
 
         print("")
         print(f"Booking flight with {booking_data['bags']} bags")
 
-        r = requests.post(self.booking_uri, data=booking_data, headers=headers)
-        r.raise_for_status()
+        # body is serialized as json, passing the dict directly would form-encode
+        # nested passengers details
+        with http_errors():
+            r = self._session.post(self.booking_uri, data=json_dumps(booking_data), headers=headers)
+            r.raise_for_status()
 
         if r.status_code in (200, 201):
-            data = r.json()
+            data = json_loads(r.content)
             print(f"Your flight was booked, booking id: {data['booking_id']}")
 
 if __name__ == '__main__':
@@ -228,9 +523,11 @@ if __name__ == '__main__':
     # production kiwi endpoint for flight search
     search_uri = 'https://api.skypicker.com/flights'
     # mock kiwi endooint for flight booking, if produciton endpoint would to be used
-    # check flights step veryfying actual flight price and availability will have to
-    # be implemented prior to booking the flight
+    # check flights endpoint below will have to be switched to production as well
     booking_uri = 'https://private-anon-7a22d853a6-skypickerbookingapi1.apiary-mock.com/api/v0.1/save_booking?v=2'
+    # mock kiwi endpoint for check flights step veryfying actual flight price
+    # and availability prior to booking the flight
+    check_uri = 'https://private-anon-7a22d853a6-skypickerbookingapi1.apiary-mock.com/api/v0.1/check_flights'
     # test user details, in production like scenario it would probably come
     # from user profile/form completed on the webpage
     test_user = {
@@ -247,5 +544,8 @@ if __name__ == '__main__':
           }
 
     input_handler = InputHandler()
-    flight_booker = FlightBooker(input_handler.args, search_uri, booking_uri, test_user)
-    flight_booker.handle_booking()
+    flight_booker = FlightBooker(input_handler.config, search_uri, booking_uri, test_user, check_uri)
+    try:
+        flight_booker.handle_booking()
+    finally:
+        close_session()